@@ -12,3 +12,11 @@ POSTGRES_PORT = try_parse(int, os.environ.get("POSTGRES_PORT")) or 5432
 POSTGRES_USER = os.environ.get("POSTGRES_USER") or "user"
 POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD") or "pass"
 POSTGRES_DB = os.environ.get("POSTGRES_DB") or "test_db"
+
+# Server configuration
+# Connection budget: every worker holds one LISTEN connection plus a pool sized
+# POSTGRES_MAX_CONNECTIONS // WEB_CONCURRENCY - 1 (at least 1), so all workers together
+# stay within POSTGRES_MAX_CONNECTIONS. Keep it below the server's max_connections
+# (100 by default) to leave room for pgadmin and maintenance sessions.
+POSTGRES_MAX_CONNECTIONS = try_parse(int, os.environ.get("POSTGRES_MAX_CONNECTIONS")) or 80
+WEB_CONCURRENCY = try_parse(int, os.environ.get("WEB_CONCURRENCY")) or min(os.cpu_count() or 1, 4)
@@ -9,3 +9,5 @@ CREATE TABLE processed_agent_data (
     longitude FLOAT,
     timestamp TIMESTAMP
 );
+
+CREATE INDEX ix_pad_user_ts ON processed_agent_data (user_id, timestamp);
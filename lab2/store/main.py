@@ -1,20 +1,63 @@
-import json
-from typing import Set, Dict, List
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
-from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, Float, DateTime
-from sqlalchemy.orm import sessionmaker
-from datetime import datetime
-from pydantic import BaseModel, field_validator
-from config import POSTGRES_HOST, POSTGRES_PORT, POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Annotated, Set, Dict, List
+import asyncpg
+import orjson
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import MetaData, Table, Column, Index, Integer, String, Float, DateTime, bindparam, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from datetime import datetime, timezone
+from pydantic import AfterValidator, AliasPath, BaseModel, Field, TypeAdapter, ValidationError
+from config import (
+    POSTGRES_HOST,
+    POSTGRES_PORT,
+    POSTGRES_DB,
+    POSTGRES_USER,
+    POSTGRES_PASSWORD,
+    POSTGRES_MAX_CONNECTIONS,
+    WEB_CONCURRENCY,
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """ Opens this worker's connection for receiving updates NOTIFY'd by every worker """
+    # Connect in the background so the worker still starts while Postgres is coming up
+    app.state.listener = None
+    app.state.listener_reconnect = asyncio.create_task(reconnect_listener())
+    yield
+    app.state.listener_reconnect.cancel()
+    if app.state.listener is not None:
+        app.state.listener.remove_termination_listener(on_listener_terminated)
+        await app.state.listener.close()
 
 # Initialize FastAPI application
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Configure database connection
-DATABASE_URL = f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
-engine = create_engine(DATABASE_URL)
+DATABASE_URL = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+# Plain asyncpg connection per worker that LISTENs on the channels of its subscribers
+LISTEN_DSN = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+# Non-blocking driver so handlers don't park the event loop while waiting on Postgres;
+# executemany() INSERTs go through asyncpg's executemany, which pipelines all rows over
+# one prepared statement instead of waiting for a round-trip per row
+engine = create_async_engine(
+    DATABASE_URL,
+    # One connection of this worker's share goes to the LISTEN connection
+    pool_size=max(1, POSTGRES_MAX_CONNECTIONS // WEB_CONCURRENCY - 1),
+    max_overflow=0,
+    pool_pre_ping=True,
+)
 metadata = MetaData()
-SessionLocal = sessionmaker(bind=engine)
+SessionLocal = async_sessionmaker(engine, expire_on_commit=False)
+# Batches at least this large are streamed with COPY instead of INSERT ... VALUES
+COPY_THRESHOLD = 500
+
+async def get_db():
+    """ Provides a pooled session per request and releases its connection afterwards """
+    async with SessionLocal() as db:
+        yield db
 
 # Define the database table schema
 processed_agent_data = Table(
@@ -30,6 +73,30 @@ processed_agent_data = Table(
     Column("longitude", Float),
     Column("timestamp", DateTime),
 )
+# Per-user / time-range lookups; also serves queries filtering on user_id alone
+Index("ix_pad_user_ts", processed_agent_data.c.user_id, processed_agent_data.c.timestamp)
+
+# Statements are built once at import and only bound to new parameters per request
+INSERT_STMT = processed_agent_data.insert()
+SELECT_BY_ID_STMT = processed_agent_data.select().where(processed_agent_data.c.id == bindparam("pid"))
+SELECT_PAGE_STMT = (
+    processed_agent_data.select()
+    .where(processed_agent_data.c.id > bindparam("after_id"))
+    .order_by(processed_agent_data.c.id)
+    .limit(bindparam("limit"))
+)
+UPDATE_BY_ID_STMT = (
+    processed_agent_data.update()
+    .where(processed_agent_data.c.id == bindparam("pid"))
+    .returning(*processed_agent_data.c)
+)
+DELETE_BY_ID_STMT = processed_agent_data.delete().where(processed_agent_data.c.id == bindparam("pid"))
+NOTIFY_STMT = text("SELECT pg_notify(:channel, :payload)")
+
+# Updates go out through Postgres NOTIFY so that any worker can reach any subscriber
+CHANNEL_PREFIX = "agent_"
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+NOTIFY_PAYLOAD_LIMIT = 8000
 
 # Define SQLAlchemy model for database interactions
 class ProcessedAgentDataInDB(BaseModel):
@@ -43,6 +110,14 @@ class ProcessedAgentDataInDB(BaseModel):
     longitude: float
     timestamp: datetime
 
+def to_naive_utc(value: datetime) -> datetime:
+    """ Converts aware timestamps to naive UTC, as the timestamp column has no time zone """
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+NaiveUtcDatetime = Annotated[datetime, AfterValidator(to_naive_utc)]
+
 # Define FastAPI models for request validation
 class AccelerometerData(BaseModel):
     x: float
@@ -57,113 +132,237 @@ class AgentData(BaseModel):
     user_id: int
     accelerometer: AccelerometerData
     gps: GpsData
-    timestamp: datetime
-
-    @classmethod
-    @field_validator("timestamp", mode="before")
-    def check_timestamp(cls, value):
-        if isinstance(value, datetime):
-            return value
-        try:
-            return datetime.fromisoformat(value)
-        except (TypeError, ValueError):
-            raise ValueError("Invalid timestamp format. Expected ISO 8601 format (YYYY-MM-DDTHH:MM:SSZ).")
+    timestamp: NaiveUtcDatetime
 
 class ProcessedAgentData(BaseModel):
     road_state: str
     agent_data: AgentData
 
+class ProcessedAgentDataFlat(BaseModel):
+    """ ProcessedAgentData payload read directly into processed_agent_data columns """
+    road_state: str
+    user_id: int = Field(validation_alias=AliasPath("agent_data", "user_id"))
+    x: float = Field(validation_alias=AliasPath("agent_data", "accelerometer", "x"))
+    y: float = Field(validation_alias=AliasPath("agent_data", "accelerometer", "y"))
+    z: float = Field(validation_alias=AliasPath("agent_data", "accelerometer", "z"))
+    latitude: float = Field(validation_alias=AliasPath("agent_data", "gps", "latitude"))
+    longitude: float = Field(validation_alias=AliasPath("agent_data", "gps", "longitude"))
+    timestamp: NaiveUtcDatetime = Field(validation_alias=AliasPath("agent_data", "timestamp"))
+
+# Validates POST bodies straight from raw JSON bytes in pydantic-core
+ProcessedAgentDataList = TypeAdapter(List[ProcessedAgentDataFlat])
+# OpenAPI body for the POST route, which reads the raw request itself. The flat model's
+# AliasPaths aren't reflected in its JSON schema, so the nested wire format is described
+# instead; its models are registered under components/schemas by the PUT route.
+PROCESSED_AGENT_DATA_LIST_SCHEMA = TypeAdapter(List[ProcessedAgentData]).json_schema(
+    ref_template="#/components/schemas/{model}"
+)
+PROCESSED_AGENT_DATA_LIST_SCHEMA.pop("$defs", None)
+
+def request_body_errors(error: ValidationError) -> List[dict]:
+    """ Reports body validation errors like FastAPI does, without echoing a raw unparseable body """
+    errors = []
+    for details in error.errors(include_url=False):
+        details = {**details, "loc": ("body", *details["loc"])}
+        if details["type"] == "json_invalid":
+            details["input"] = {}
+        errors.append(details)
+    return errors
+
 # WebSocket subscriptions for real-time updates
 subscriptions: Dict[int, Set[WebSocket]] = {}
+# Serializes LISTEN/UNLISTEN on the shared listener connection
+subscriptions_lock = asyncio.Lock()
 
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: int):
     """ WebSocket connection handler for live updates """
     await websocket.accept()
-    if user_id not in subscriptions:
-        subscriptions[user_id] = set()
-    subscriptions[user_id].add(websocket)
+    async with subscriptions_lock:
+        subscribed = True
+        if user_id not in subscriptions:
+            listener = app.state.listener
+            try:
+                if listener is None or listener.is_closed():
+                    raise ConnectionError("listener connection is not open")
+                await listener.add_listener(f"{CHANNEL_PREFIX}{user_id}", forward_notification)
+                subscriptions[user_id] = set()
+            except (ConnectionError, asyncpg.InterfaceError, asyncpg.PostgresError) as e:
+                print(f"Listener subscription error: {e}")
+                subscribed = False
+        if subscribed:
+            subscriptions[user_id].add(websocket)
+    if not subscribed:
+        # 1013 "Try Again Later": the listener is reconnecting
+        await websocket.close(code=1013)
+        return
     try:
         while True:
             await websocket.receive_text()
     except WebSocketDisconnect:
-        subscriptions[user_id].remove(websocket)
+        pass
+    finally:
+        async with subscriptions_lock:
+            subscriptions[user_id].remove(websocket)
+            if not subscriptions[user_id]:
+                del subscriptions[user_id]
+                await app.state.listener.remove_listener(f"{CHANNEL_PREFIX}{user_id}", forward_notification)
+
+async def connect_listener():
+    """ Opens the LISTEN connection and subscribes it to the channels of connected users """
+    listener = await asyncpg.connect(LISTEN_DSN)
+    try:
+        for user_id in subscriptions:
+            await listener.add_listener(f"{CHANNEL_PREFIX}{user_id}", forward_notification)
+    except BaseException:
+        await listener.close()
+        raise
+    listener.add_termination_listener(on_listener_terminated)
+    app.state.listener = listener
+
+def on_listener_terminated(connection):
+    """ Schedules a reconnect when the LISTEN connection is lost """
+    app.state.listener_reconnect = asyncio.create_task(reconnect_listener())
+
+async def reconnect_listener():
+    """ Reopens the LISTEN connection with exponential backoff until it succeeds """
+    backoff = 1
+    while True:
+        try:
+            async with subscriptions_lock:
+                await connect_listener()
+            return
+        except Exception as e:
+            print(f"Listener connection error: {e}")
+        await asyncio.sleep(backoff)
+        backoff = min(30, backoff * 2)
+
+async def forward_notification(connection, pid, channel, payload):
+    """ Relays a NOTIFY from any worker to the WebSockets connected to this worker """
+    await send_data_to_subscribers(int(channel[len(CHANNEL_PREFIX):]), payload)
 
-async def send_data_to_subscribers(user_id: int, data):
+def notify_payloads(rows: List[dict]):
+    """ Encodes rows as JSON arrays that each fit into a single NOTIFY payload """
+    chunk: List[bytes] = []
+    size = 2
+    for row in rows:
+        encoded = orjson.dumps(row)
+        if chunk and size + len(encoded) + 1 >= NOTIFY_PAYLOAD_LIMIT:
+            yield (b"[" + b",".join(chunk) + b"]").decode()
+            chunk, size = [], 2
+        chunk.append(encoded)
+        size += len(encoded) + 1
+    if chunk:
+        yield (b"[" + b",".join(chunk) + b"]").decode()
+
+async def send_data_to_subscribers(user_id: int, payload: str):
     """ Sends real-time data updates to subscribed clients """
     if user_id in subscriptions:
-        for websocket in subscriptions[user_id]:
-            await websocket.send_json(json.dumps(data))
+        # Fan out concurrently so one slow client doesn't delay the rest
+        await asyncio.gather(
+            *(websocket.send_text(payload) for websocket in list(subscriptions[user_id])),
+            return_exceptions=True,
+        )
 
 # 💾 CRUD API
 
-@app.post("/processed_agent_data/")
-async def create_processed_agent_data(data: List[ProcessedAgentData]):
+@app.post(
+    "/processed_agent_data/",
+    openapi_extra={
+        "requestBody": {
+            "content": {"application/json": {"schema": PROCESSED_AGENT_DATA_LIST_SCHEMA}},
+            "required": True,
+        },
+    },
+)
+async def create_processed_agent_data(request: Request, db: AsyncSession = Depends(get_db)):
     """ Inserts new processed agent data into the database """
-    db = SessionLocal()
-    mapped_data = [
-        {
-            "road_state": d.road_state,
-            "user_id": d.agent_data.user_id,
-            "x": d.agent_data.accelerometer.x,
-            "y": d.agent_data.accelerometer.y,
-            "z": d.agent_data.accelerometer.z,
-            "latitude": d.agent_data.gps.latitude,
-            "longitude": d.agent_data.gps.longitude,
-            "timestamp": d.agent_data.timestamp
-        }
-        for d in data
+    try:
+        data = ProcessedAgentDataList.validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(request_body_errors(e))
+    mapped_data = [d.model_dump() for d in data]
+    updates: Dict[int, List[dict]] = {}
+    for row in mapped_data:
+        updates.setdefault(row["user_id"], []).append(row)
+    notifications = [
+        {"channel": f"{CHANNEL_PREFIX}{user_id}", "payload": payload}
+        for user_id, user_data in updates.items()
+        for payload in notify_payloads(user_data)
     ]
-    db.execute(processed_agent_data.insert(), mapped_data)
-    db.commit()
-    for d in data:
-        await send_data_to_subscribers(d.agent_data.user_id, d)
+    async with db.begin():
+        # Postgres delivers these to listening workers only once the transaction commits.
+        # Issuing them first also opens the driver transaction that the COPY below joins.
+        if notifications:
+            await db.execute(NOTIFY_STMT, notifications)
+        if len(mapped_data) >= COPY_THRESHOLD:
+            connection = await db.connection()
+            raw_connection = await connection.get_raw_connection()
+            driver_connection = raw_connection.driver_connection
+            # COPY bypasses SQLAlchemy, which only opens the driver transaction on its first
+            # execute; outside of one the COPY would autocommit regardless of the rollback
+            if not driver_connection.is_in_transaction():
+                raise RuntimeError("COPY must run inside the request transaction")
+            await driver_connection.copy_records_to_table(
+                processed_agent_data.name,
+                records=[tuple(row.values()) for row in mapped_data],
+                columns=list(mapped_data[0]),
+            )
+        else:
+            await db.execute(INSERT_STMT, mapped_data)
     return {"status": "success"}
 
 @app.get("/processed_agent_data/{processed_agent_data_id}", response_model=ProcessedAgentDataInDB)
-def read_processed_agent_data(processed_agent_data_id: int):
+async def read_processed_agent_data(processed_agent_data_id: int, db: AsyncSession = Depends(get_db)):
     """ Retrieves a specific processed agent data entry by ID """
-    db = SessionLocal()
-    query = db.execute(processed_agent_data.select().where(processed_agent_data.c.id == processed_agent_data_id))
-    result = query.fetchone()
+    async with db.begin():
+        query = await db.execute(SELECT_BY_ID_STMT, {"pid": processed_agent_data_id})
+        result = query.fetchone()
     if not result:
         raise HTTPException(status_code=404, detail="Data not found")
-    return ProcessedAgentDataInDB(**dict(result))
+    return ProcessedAgentDataInDB(**result._mapping)
 
 @app.get("/processed_agent_data/", response_model=List[ProcessedAgentDataInDB])
-def list_processed_agent_data():
-    """ Retrieves all processed agent data entries """
-    db = SessionLocal()
-    query = db.execute(processed_agent_data.select())
-    return [ProcessedAgentDataInDB(**dict(r)) for r in query.fetchall()]
+async def list_processed_agent_data(
+    limit: int = Query(100, ge=1, le=1000),
+    after_id: int = 0,
+    db: AsyncSession = Depends(get_db),
+):
+    """ Retrieves a page of processed agent data entries with id greater than after_id """
+    async with db.begin():
+        query = await db.execute(SELECT_PAGE_STMT, {"after_id": after_id, "limit": limit})
+        rows = query.fetchall()
+    return [ProcessedAgentDataInDB(**r._mapping) for r in rows]
 
 @app.put("/processed_agent_data/{processed_agent_data_id}", response_model=ProcessedAgentDataInDB)
-def update_processed_agent_data(processed_agent_data_id: int, data: ProcessedAgentData):
+async def update_processed_agent_data(processed_agent_data_id: int, data: ProcessedAgentData, db: AsyncSession = Depends(get_db)):
     """ Updates an existing processed agent data entry """
-    db = SessionLocal()
-    db.execute(processed_agent_data.update().where(processed_agent_data.c.id == processed_agent_data_id).values(
-        road_state=data.road_state,
-        user_id=data.agent_data.user_id,
-        x=data.agent_data.accelerometer.x,
-        y=data.agent_data.accelerometer.y,
-        z=data.agent_data.accelerometer.z,
-        latitude=data.agent_data.gps.latitude,
-        longitude=data.agent_data.gps.longitude,
-        timestamp=data.agent_data.timestamp
-    ))
-    db.commit()
-    return read_processed_agent_data(processed_agent_data_id)
+    async with db.begin():
+        query = await db.execute(UPDATE_BY_ID_STMT, {
+            "pid": processed_agent_data_id,
+            "road_state": data.road_state,
+            "user_id": data.agent_data.user_id,
+            "x": data.agent_data.accelerometer.x,
+            "y": data.agent_data.accelerometer.y,
+            "z": data.agent_data.accelerometer.z,
+            "latitude": data.agent_data.gps.latitude,
+            "longitude": data.agent_data.gps.longitude,
+            "timestamp": data.agent_data.timestamp
+        })
+        result = query.fetchone()
+    if not result:
+        raise HTTPException(status_code=404, detail="Data not found")
+    return ProcessedAgentDataInDB(**result._mapping)
 
 @app.delete("/processed_agent_data/{processed_agent_data_id}", response_model=dict)
-def delete_processed_agent_data(processed_agent_data_id: int):
+async def delete_processed_agent_data(processed_agent_data_id: int, db: AsyncSession = Depends(get_db)):
     """ Deletes a processed agent data entry by ID """
-    db = SessionLocal()
-    result = db.execute(processed_agent_data.delete().where(processed_agent_data.c.id == processed_agent_data_id))
-    db.commit()
+    async with db.begin():
+        result = await db.execute(DELETE_BY_ID_STMT, {"pid": processed_agent_data_id})
     if result.rowcount == 0:
         raise HTTPException(status_code=404, detail="Data not found")
     return {"status": "deleted"}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    uvicorn.run("main:app", host="127.0.0.1", port=8000, workers=WEB_CONCURRENCY)
@@ -0,0 +1,75 @@
+import unittest
+from datetime import datetime
+import orjson
+from main import AgentData, NOTIFY_PAYLOAD_LIMIT, ProcessedAgentDataList, notify_payloads
+
+class TestProcessedAgentData(unittest.TestCase):
+    def test_aware_timestamp_becomes_naive_utc(self):
+        # Test that a timestamp with an offset is stored as naive UTC
+        body = b'[{"road_state": "normal", "agent_data": {"user_id": 1, "accelerometer": {"x": 0.1, "y": 0.2, "z": 0.3}, "gps": {"latitude": 10.123, "longitude": 20.456}, "timestamp": "2023-07-21T12:34:56+02:00"}}]'
+        data = ProcessedAgentDataList.validate_json(body)
+        self.assertEqual(data[0].timestamp, datetime(2023, 7, 21, 10, 34, 56))
+        self.assertIsNone(data[0].timestamp.tzinfo)
+    def test_utc_timestamp_in_agent_data(self):
+        # Test the documented YYYY-MM-DDTHH:MM:SSZ format on the nested model used by PUT
+        agent_data = AgentData(
+            user_id=1,
+            accelerometer={"x": 0.1, "y": 0.2, "z": 0.3},
+            gps={"latitude": 10.123, "longitude": 20.456},
+            timestamp="2023-07-21T12:34:56Z",
+        )
+        self.assertEqual(agent_data.timestamp, datetime(2023, 7, 21, 12, 34, 56))
+        self.assertIsNone(agent_data.timestamp.tzinfo)
+    def test_naive_timestamp_unchanged(self):
+        # Test that a timestamp without an offset is kept as is
+        agent_data = AgentData(
+            user_id=1,
+            accelerometer={"x": 0.1, "y": 0.2, "z": 0.3},
+            gps={"latitude": 10.123, "longitude": 20.456},
+            timestamp="2023-07-21T12:34:56",
+        )
+        self.assertEqual(agent_data.timestamp, datetime(2023, 7, 21, 12, 34, 56))
+    def test_flat_model_dump_matches_columns(self):
+        # Test that nested input is flattened into the processed_agent_data columns
+        body = b'[{"road_state": "normal", "agent_data": {"user_id": 1, "accelerometer": {"x": 0.1, "y": 0.2, "z": 0.3}, "gps": {"latitude": 10.123, "longitude": 20.456}, "timestamp": "2023-07-21T12:34:56Z"}}]'
+        data = ProcessedAgentDataList.validate_json(body)
+        self.assertEqual(
+            data[0].model_dump(),
+            {
+                "road_state": "normal",
+                "user_id": 1,
+                "x": 0.1,
+                "y": 0.2,
+                "z": 0.3,
+                "latitude": 10.123,
+                "longitude": 20.456,
+                "timestamp": datetime(2023, 7, 21, 12, 34, 56),
+            },
+        )
+    def test_notify_payloads_fit_limit_and_keep_rows(self):
+        # Test that a COPY-sized batch is split into payloads Postgres accepts, losing no rows
+        rows = [
+            {
+                "road_state": "normal",
+                "user_id": 1,
+                "x": i * 0.1,
+                "y": 0.2,
+                "z": 0.3,
+                "latitude": 10.123,
+                "longitude": 20.456,
+                "timestamp": datetime(2023, 7, 21, 12, 34, 56),
+            }
+            for i in range(2000)
+        ]
+        payloads = list(notify_payloads(rows))
+        self.assertGreater(len(payloads), 1)
+        for payload in payloads:
+            self.assertLess(len(payload.encode()), NOTIFY_PAYLOAD_LIMIT)
+        received = [row for payload in payloads for row in orjson.loads(payload)]
+        self.assertEqual(received, orjson.loads(orjson.dumps(rows)))
+    def test_notify_payloads_empty(self):
+        # Test that no payload is produced for no rows
+        self.assertEqual(list(notify_payloads([])), [])
+
+if __name__ == "__main__":
+    unittest.main()
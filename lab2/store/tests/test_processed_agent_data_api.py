@@ -0,0 +1,63 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+from fastapi.testclient import TestClient
+from main import SELECT_PAGE_STMT, app, get_db
+
+class TestProcessedAgentDataApi(unittest.TestCase):
+    def setUp(self):
+        # Replace the database session with a mock returning no rows
+        self.mock_db = MagicMock()
+        self.mock_db.begin.return_value.__aenter__ = AsyncMock()
+        self.mock_db.begin.return_value.__aexit__ = AsyncMock(return_value=False)
+        self.mock_db.execute = AsyncMock(return_value=MagicMock(fetchall=MagicMock(return_value=[])))
+        async def override_get_db():
+            yield self.mock_db
+        app.dependency_overrides[get_db] = override_get_db
+        # The client is not entered, so the LISTEN connection is not opened
+        self.client = TestClient(app)
+    def tearDown(self):
+        app.dependency_overrides.clear()
+    def test_create_invalid_item_reports_nested_location(self):
+        # Test that validation errors point into the nested request body
+        body = b'[{"road_state": "normal", "agent_data": {"user_id": 1, "accelerometer": {"x": 0.1, "y": 0.2, "z": 0.3}, "gps": {"longitude": 20.456}, "timestamp": "2023-07-21T12:34:56Z"}}]'
+        response = self.client.post("/processed_agent_data/", content=body)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(
+            [error["loc"] for error in response.json()["detail"]],
+            [["body", 0, "agent_data", "gps", "latitude"]],
+        )
+        self.mock_db.execute.assert_not_called()
+    def test_create_invalid_json_does_not_echo_body(self):
+        # Test that an unparseable, non-UTF-8 body is rejected without echoing it back
+        response = self.client.post("/processed_agent_data/", content=b"\xff\xfe")
+        self.assertEqual(response.status_code, 422)
+        error = response.json()["detail"][0]
+        self.assertEqual(error["type"], "json_invalid")
+        self.assertEqual(error["loc"], ["body"])
+        self.assertEqual(error["input"], {})
+    def test_list_default_page(self):
+        # Test that the list endpoint queries the first page of 100 rows by default
+        response = self.client.get("/processed_agent_data/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [])
+        self.mock_db.execute.assert_awaited_once_with(SELECT_PAGE_STMT, {"after_id": 0, "limit": 100})
+    def test_list_limit_bounds(self):
+        # Test that the page size is limited to 1..1000
+        self.assertEqual(self.client.get("/processed_agent_data/?limit=0").status_code, 422)
+        self.assertEqual(self.client.get("/processed_agent_data/?limit=1001").status_code, 422)
+        self.mock_db.execute.assert_not_called()
+        response = self.client.get("/processed_agent_data/?limit=1000&after_id=42")
+        self.assertEqual(response.status_code, 200)
+        self.mock_db.execute.assert_awaited_once_with(SELECT_PAGE_STMT, {"after_id": 42, "limit": 1000})
+    def test_openapi_declares_create_body(self):
+        # Test that the raw-body POST route still documents its request body
+        schema = self.client.get("/openapi.json").json()
+        request_body = schema["paths"]["/processed_agent_data/"]["post"]["requestBody"]
+        self.assertEqual(
+            request_body["content"]["application/json"]["schema"],
+            {"type": "array", "items": {"$ref": "#/components/schemas/ProcessedAgentData"}},
+        )
+        self.assertIn("ProcessedAgentData", schema["components"]["schemas"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,9 @@
 import asyncio
-import json
+import orjson
 import random
-from threading import Thread
 import lineMapLayer
 
 from kivy.app import App
-from kivy.clock import Clock
 from kivy_garden.mapview import MapMarker, MapView, MapLayer
 import fileDatasource
 import websockets
@@ -17,7 +15,8 @@ class MapViewApp(App):
     def __init__(self):
         super().__init__()
         self.lineMapLayer = lineMapLayer.LineMapLayer()
-        self.car_marker = MapMarker()
+        self.car_marker = None
+        self.websocket_task = None
 
     def on_start(self):
         """
@@ -26,55 +25,74 @@ class MapViewApp(App):
         speed_bump_cor = fileDatasource.get_bump_cor()
         pothole_cor = fileDatasource.get_pothole_cor()
 
-        for _, point in pothole_cor.iterrows():
+        for point in pothole_cor.to_numpy():
             self.set_pothole_marker(point)
 
-        for _, point in speed_bump_cor.iterrows():
+        for point in speed_bump_cor.to_numpy():
             self.set_bump_marker(point)
 
-        self.start_websocket_listener()
-
-    def start_websocket_listener(self):
-        websocket_thread = Thread(target=self.run_websocket_client, daemon=True)
-        websocket_thread.start()
+        self.car_marker = MapMarker(source="images/car.png")
+        self.mapview.add_marker(self.car_marker)
+        # Застосунок запущено через async_run, тож клієнт працює в тому ж циклі подій, що й Kivy
+        self.websocket_task = asyncio.ensure_future(self.connect_to_websocket())
 
-    def run_websocket_client(self):
+    def on_stop(self):
         """
-        Клієнт WebSocket, що працює в окремому потоці.
-        Виконує асинхронний метод `connect_to_websocket` у циклі подій asyncio.
+        Зупиняє клієнт WebSocket під час закриття застосунку
         """
-        asyncio.run(self.connect_to_websocket())
+        if self.websocket_task is not None:
+            self.websocket_task.cancel()
 
     async def connect_to_websocket(self):
         """
         Асинхронний клієнт WebSocket, який отримує оновлення в режимі реального часу.
-        """
-        try:
-            async with websockets.connect(self.server_uri,  ping_interval=300, ping_timeout=100) as websocket:
-                print(f"Connected to {self.server_uri}")
-                while True:
-                    message = await websocket.recv()
-                    self.process_websocket_message(message)
-        except Exception as e:
-            print(f"WebSocket connection error: {e}")
+        Після розриву з'єднання перепідключається з експоненційною затримкою.
+        """
+        backoff = 1
+        while True:
+            try:
+                async with websockets.connect(self.server_uri) as websocket:
+                    print(f"Connected to {self.server_uri}")
+                    backoff = 1
+                    while True:
+                        message = await websocket.recv()
+                        self.process_websocket_message(message)
+            except Exception as e:
+                print(f"WebSocket connection error: {e}")
+            await asyncio.sleep(random.uniform(0, backoff))
+            backoff = min(60, backoff * 2)
 
     def process_websocket_message(self, message):
         """
-        Обробляє вхідне повідомлення та планує оновлення маркера в основному потоці Kivy.
-        :param message: Рядок JSON від WebSocket, наприклад: {"lat": 50.4475, "lon": 30.4520}
+        Обробляє вхідне повідомлення та оновлює маркер машини.
+        :param message: Рядок JSON від WebSocket, наприклад:
+            [{"road_state": "normal", "user_id": 1, "latitude": 50.4475, "longitude": 30.4520, ...}]
+            або {"gps": {"latitude": 50.4475, "longitude": 30.4520}}
         """
         try:
-            data = json.loads(message)
-            point = data.get("gps")
-            lat = point.get("latitude")
-            lon = point.get("longitude")
-            point = (lat, lon)
-
-            if lat is not None and lon is not None:
-                Clock.schedule_once(lambda dt: self.update_car_marker(point))
-        except json.JSONDecodeError:
+            data = orjson.loads(message)
+        except orjson.JSONDecodeError:
             print(f"Invalid message format: {message}")
+            return
 
+        # Store надсилає пакет плоских оброблених записів; поточну позицію містить останній з них
+        if isinstance(data, list):
+            point = data[-1] if data else None
+        elif isinstance(data, dict):
+            point = data.get("gps")
+        else:
+            point = None
+        if not isinstance(point, dict):
+            print(f"Unexpected message shape: {message}")
+            return
+
+        try:
+            lat = float(point.get("latitude"))
+            lon = float(point.get("longitude"))
+        except (TypeError, ValueError):
+            print(f"Invalid coordinates: {message}")
+            return
+        self.update_car_marker((lat, lon))
 
     def update_car_marker(self, point):
         """
@@ -82,16 +100,15 @@ class MapViewApp(App):
         :param point: GPS координати
 
         """
-        self.mapview.remove_marker(self.car_marker)
-        self.car_marker = MapMarker(lat=point[0], lon=point[1], source="images/car.png")
-        self.mapview.add_marker(self.car_marker)
+        self.car_marker.lat, self.car_marker.lon = point
+        self.mapview.trigger_update(False)
 
     def set_pothole_marker(self, point):
         """
         Встановлює маркер для ями
         :param point: GPS координати
         """
-        pothole_marker = MapMarker(lat=float(point[0]), lon=float(point[1]), source='images/pothole.png')
+        pothole_marker = MapMarker(lat=point[0], lon=point[1], source='images/pothole.png')
         self.mapview.add_marker(pothole_marker)
 
     def set_bump_marker(self, point):
@@ -99,7 +116,7 @@ class MapViewApp(App):
         Встановлює маркер для лежачого поліцейського
         :param point: GPS координати
         """
-        bump_marker = MapMarker(lat=float(point[0]), lon=float(point[1]), source='images/bump.png')
+        bump_marker = MapMarker(lat=point[0], lon=point[1], source='images/bump.png')
         self.mapview.add_marker(bump_marker)
 
     def build(self):
@@ -115,4 +132,4 @@ if __name__ == '__main__':
     mapp = MapViewApp()
     mapp.build()
     mapp.set_bump_marker([50.447465, 30.45176])
-    mapp.run()
+    asyncio.run(mapp.async_run(async_lib='asyncio'))